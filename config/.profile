@@ -45,6 +45,9 @@ livedeploy ()
     cd /var/www/{{domain}}
     git fetch --all
     git checkout --force \"origin/master\"
+{%- if use_microcache %}
+    sudo find /var/cache/nginx/{{domain}} -type f -delete
+{%- endif %}
     exit
 }
 
@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+"""
+Samples host and service resource use of {{server_name}}.{{domain}} every
+{{interval}} seconds into a fixed size ring file, so memory and disk use stay
+bounded however long it runs. Generated by the setup_metrics_agent fab task,
+the collect_metrics task reads the ring file back.
+"""
+import os
+import struct
+import subprocess
+import time
+
+RING_FILE = '{{ring_file}}'
+RING_HEADER = '{{ring_header}}'
+RING_MAGIC = b'{{ring_magic}}'
+# The count of samples written comes after the magic, capacity and field count
+WRITTEN_OFFSET = struct.calcsize(RING_HEADER[:RING_HEADER.index('Q')])
+CAPACITY = {{capacity}}
+INTERVAL = {{interval}}
+
+# Process names (as in /proc/<pid>/comm) of each service
+SERVICE_PROCESSES = {{service_processes}}
+
+USE_POSTGRES = {{use_postgres}}
+PG_COMMAND = ['psql', '-h', 'localhost', '-U', '{{db_user}}', '-d', '{{db_name}}', '-Atc',
+              'SELECT (SELECT count(*) FROM pg_stat_activity), sum(xact_commit), '
+              'sum(blks_read), sum(blks_hit) FROM pg_stat_database']
+PG_ENV = dict(os.environ, PGPASSWORD='{{db_password}}')
+
+USE_MAIL = {{use_mail}}
+
+
+def fields():
+    """
+    Returns the names of the values in every sample
+    """
+    names = ['time', 'cpu_busy_pct', 'cpu_iowait_pct', 'load1',
+             'mem_used_mb', 'mem_cached_mb', 'swap_used_mb',
+             'disk_read_kbs', 'disk_write_kbs']
+    names += ['rss_mb:%s' % service for (service, _) in SERVICE_PROCESSES]
+    if USE_POSTGRES:
+        names += ['pg_connections', 'pg_commits_s', 'pg_blks_read_s', 'pg_blks_hit_s']
+    if USE_MAIL:
+        names += ['mail_queue']
+    return names
+
+
+def read_cpu():
+    """
+    Returns the busy, iowait and total cpu time since boot
+    """
+    with open('/proc/stat') as fh:
+        values = [int(value) for value in fh.readline().split()[1:]]
+    idle, iowait = values[3], values[4]
+    total = sum(values[:8])
+    return total - idle - iowait, iowait, total
+
+
+def read_memory():
+    """
+    Returns used, cached and used swap memory in MB
+    """
+    meminfo = {}
+    with open('/proc/meminfo') as fh:
+        for line in fh:
+            (key, value) = line.split(':', 1)
+            meminfo[key] = int(value.split()[0])
+    cached = meminfo['Cached'] + meminfo['Buffers']
+    used = meminfo['MemTotal'] - meminfo['MemFree'] - cached
+    swap_used = meminfo['SwapTotal'] - meminfo['SwapFree']
+    return used / 1024.0, cached / 1024.0, swap_used / 1024.0
+
+
+def read_disks():
+    """
+    Returns the KB read and written by all disks since boot
+    """
+    read_kb = written_kb = 0
+    with open('/proc/diskstats') as fh:
+        for line in fh:
+            values = line.split()
+            # Whole disks only, partitions are counted in their disk already
+            if not os.path.exists('/sys/block/%s/device' % values[2]):
+                continue
+            read_kb += int(values[5]) / 2.0
+            written_kb += int(values[9]) / 2.0
+    return read_kb, written_kb
+
+
+def read_service_rss():
+    """
+    Returns the resident memory in MB of all the processes of each service
+    """
+    services = dict((name, service) for (service, names) in SERVICE_PROCESSES for name in names)
+    rss = dict((service, 0.0) for (service, _) in SERVICE_PROCESSES)
+    for pid in os.listdir('/proc'):
+        if not pid.isdigit():
+            continue
+        try:
+            with open('/proc/%s/comm' % pid) as fh:
+                service = services.get(fh.read().strip())
+            if service is None:
+                continue
+            with open('/proc/%s/status' % pid) as fh:
+                for line in fh:
+                    if line.startswith('VmRSS:'):
+                        rss[service] += int(line.split()[1]) / 1024.0
+        except (IOError, OSError):
+            # The process ended while it was being read
+            continue
+    return [rss[service] for (service, _) in SERVICE_PROCESSES]
+
+
+def read_postgres():
+    """
+    Returns the number of connections and the commits, blocks read and blocks
+    found in the buffer cache since the statistics were reset
+    """
+    try:
+        output = subprocess.check_output(PG_COMMAND, env=PG_ENV).decode()
+        return [float(value or 0) for value in output.strip().split('|')]
+    except (OSError, subprocess.CalledProcessError, ValueError):
+        return [float('nan')] * 4
+
+
+def read_mail_queue():
+    """
+    Returns the number of messages in the postfix queue
+    """
+    try:
+        output = subprocess.check_output(['postqueue', '-p']).decode()
+    except (OSError, subprocess.CalledProcessError):
+        return float('nan')
+    last_line = output.strip().splitlines()[-1]
+    if last_line.startswith('--'):
+        return float(last_line.split()[-2])
+    return 0.0
+
+
+def open_ring(names):
+    """
+    Opens the ring file, creating it at full size if it doesn't exist or was
+    made for different fields, and returns it with the number of samples
+    written so far
+    """
+    names_bytes = ','.join(names).encode('ascii')
+    header_size = struct.calcsize(RING_HEADER)
+    record_size = struct.calcsize('<%dd' % len(names))
+
+    if os.path.exists(RING_FILE):
+        fh = open(RING_FILE, 'r+b')
+        (magic, capacity, field_count, written, stored_names) = struct.unpack(
+            RING_HEADER, fh.read(header_size))
+        if (magic, capacity, stored_names.rstrip(b'\0')) == (RING_MAGIC, CAPACITY, names_bytes):
+            return fh, written
+        fh.close()
+
+    fh = open(RING_FILE, 'w+b')
+    fh.write(struct.pack(RING_HEADER, RING_MAGIC, CAPACITY, len(names), 0, names_bytes))
+    fh.truncate(header_size + CAPACITY * record_size)
+    fh.flush()
+    return fh, 0
+
+
+def main():
+    names = fields()
+    record = struct.Struct('<%dd' % len(names))
+    header_size = struct.calcsize(RING_HEADER)
+    (fh, written) = open_ring(names)
+
+    previous = None
+    while True:
+        now = time.time()
+        cpu = read_cpu()
+        disks = read_disks()
+        pg = read_postgres() if USE_POSTGRES else []
+
+        # Rates need two readings, so the first one is only remembered
+        if previous is not None:
+            (prev_time, prev_cpu, prev_disks, prev_pg) = previous
+            elapsed = now - prev_time
+            cpu_total = max(cpu[2] - prev_cpu[2], 1)
+            with open('/proc/loadavg') as load_fh:
+                load1 = float(load_fh.read().split()[0])
+
+            values = [now,
+                      100.0 * (cpu[0] - prev_cpu[0]) / cpu_total,
+                      100.0 * (cpu[1] - prev_cpu[1]) / cpu_total,
+                      load1]
+            values += read_memory()
+            values += [(disks[0] - prev_disks[0]) / elapsed, (disks[1] - prev_disks[1]) / elapsed]
+            values += read_service_rss()
+            if USE_POSTGRES:
+                values += [pg[0]] + [(pg[idx] - prev_pg[idx]) / elapsed for idx in (1, 2, 3)]
+            if USE_MAIL:
+                values += [read_mail_queue()]
+
+            # Write the sample over the oldest one, then count it
+            fh.seek(header_size + (written % CAPACITY) * record.size)
+            fh.write(record.pack(*values))
+            written += 1
+            fh.seek(WRITTEN_OFFSET)
+            fh.write(struct.pack('<Q', written))
+            fh.flush()
+
+        previous = (now, cpu, disks, pg)
+        time.sleep(max(0, INTERVAL - (time.time() - now)))
+
+
+if __name__ == '__main__':
+    main()
@@ -7,7 +7,7 @@ TEMPLATE_DEBUG = {{template_debug}}
 DATABASE_NAME = '{{django_db_name}}'
 DATABASE_USER = '{{django_db_user}}'
 DATABASE_PASSWORD = '{{django_db_pwd}}'
-DATABASE_HOST = 'localhost'
+DATABASE_HOST = '{{django_db_host}}'
 DATABASE_PORT = '5432'
 MAIL_USER = '{{username_email}}'
 MAIL_PASSWORD = '{{password_email}}'
@@ -30,4 +30,45 @@ postgres_version = '9.3'
 password_login = 'no'
 use_https = True
 local_test_db = True
-remove_temp_files = True
\ No newline at end of file
+remove_temp_files = True
+# Services running on this host, used to size kernel and file limits.
+# Any of 'web' (nginx + uWSGI), 'postgres' and 'mail'
+services = ['web', 'postgres', 'mail']
+# Swap for low memory hosts, can be 'swapfile', 'zram' or None
+swap_type = 'swapfile'
+swap_low_memory_mb = 2048  # only add swap below this much RAM
+swap_size_mb = None  # defaults to the size of RAM
+# Local directory of .deb files shared by all servers (see the
+# fetch_package_cache task), None to install from the mirrors
+package_cache_dir = None
+# Database backups, stored on the local machine
+backup_dir = 'backups'
+backup_jobs = None  # parallel pg_dump/pg_restore jobs, defaults to server cores
+backup_compression = 3  # 0-9
+db_tunnel_port = 15432  # local port forwarded to postgres on the server
+# TLS key type, 'ecdsa' (P-256) or 'rsa' for older clients
+ssl_key_type = 'ecdsa'
+ssl_rsa_bits = 2048
+ssl_ocsp_stapling = False  # only works with a CA signed certificate
+# nginx microcache for anonymous requests
+use_microcache = False
+microcache_size_mb = 64
+microcache_ttl = 5  # seconds
+# Multi node topology. By default the whole stack runs on ip_address. App
+# nodes running uWSGI are added with "fab add_app_node:{public ip},{private ip}"
+# and nginx on ip_address (the front node) reaches them on the private network.
+private_ip_address = None  # private address of the front node
+uwsgi_port = 8001  # uWSGI port on the app nodes
+# Separate postgres node, set up by full_deploy (see setup_db_node) after
+# full_setup was run on it
+db_node_ip = None  # address of a separate postgres node, None for ip_address
+db_private_ip = None  # private address of the postgres node
+# SpamAssassin spam filtering
+use_spamassassin = True
+spam_required_score = 5.0
+spam_reject_score = 15  # reject mail at SMTP time from this score, None to keep it all
+spam_max_size = 512000  # bytes, larger messages are not scanned
+spam_bayes_store = 'dbm'  # 'dbm' or 'redis'
+# Metrics agent, samples are kept in a ring of metrics_capacity samples
+metrics_interval = 10  # seconds
+metrics_capacity = 8640  # one day at 10 second intervals
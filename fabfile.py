@@ -10,17 +10,89 @@ Author: Daniel Kuntz
 import deploy_settings as ds
 
 # Imports
-from os import path
+from os import path, listdir
 from fabric.api import run, get, put, sudo, hosts, local, settings
 from fabric.context_managers import cd, lcd
+from fabric.utils import puts, warn, abort
+from fabric.contrib.console import confirm
 from jinja2 import Environment, FileSystemLoader
 from string import ascii_letters, digits
 from random import SystemRandom
+from multiprocessing.pool import ThreadPool
+from smtplib import SMTP, SMTPException
+from time import time, strftime, localtime
+import struct
 import json
+import csv
 
 # Set up Jinja environment
 template_env = Environment(loader=FileSystemLoader('config'))
 
+# Packages needed by each deployment task
+package_manifest = {
+    'install_postgres': [
+        'postgresql-%s' % ds.postgres_version,
+        'postgresql-contrib-%s' % ds.postgres_version,
+        'postgresql-server-dev-%s' % ds.postgres_version,
+    ],
+    'install_mail_system': [
+        'postfix',
+        'dovecot-imapd',
+        'opendkim',
+        'opendkim-tools',
+    ],
+    'install_nginx': [
+        'nginx-full',
+    ],
+    'install_python': [
+        'python%s-dev' % ds.python_version,
+        'libpcre3-dev',
+        'libssl-dev',
+        'gfortran',
+        'libopenblas-dev',
+        'liblapack-dev',
+        'libfreetype6-dev',
+        'libxft-dev',
+        'python-virtualenv',
+    ],
+    'setup_repo': [
+        'git',
+    ],
+    'setup_spamassassin': [
+        'spamassassin',
+        'spamc',
+        'spamass-milter',
+    ] + (['redis-server'] if ds.spam_bayes_store == 'redis' else []),
+}
+
+# Answers to the installation questions asked by packages in the manifest
+debconf_manifest = {
+    'install_mail_system': [
+        'postfix postfix/mailname string %s' % ds.domain,
+        'postfix postfix/main_mailer_type string Internet Site',
+        'dovecot-core dovecot-core/create-ssl-cert boolean false',
+    ],
+}
+
+# Tasks run by full_deploy that install packages
+deploy_package_tasks = [
+    'install_mail_system',
+    'install_nginx',
+    'install_python',
+    'setup_repo',
+]
+if not ds.db_node_ip:
+    deploy_package_tasks.insert(0, 'install_postgres')
+if ds.use_spamassassin:
+    deploy_package_tasks.append('setup_spamassassin')
+
+# Layout of the ring file written by the metrics agent, the header holds the
+# magic, capacity, field count, samples written and the comma separated field
+# names, followed by capacity records of one double per field
+metrics_ring_file = '/var/lib/pyserver-metrics/metrics.ring'
+metrics_ring_header = '<8sIIQ1024s'
+metrics_ring_magic = 'PYSMETR1'
+
 
 @hosts('root@%s' % ds.ip_address)
 def full_setup():
@@ -34,6 +106,7 @@ def full_setup():
     setup_users()
     setup_firewall()
     setup_fail2ban()
+    setup_system_tuning()
     remove_root_login()
     restart()
 
@@ -41,11 +114,19 @@ def full_setup():
 @hosts('%s@%s' % (ds.username_main, ds.ip_address))
 def full_deploy():
     """
-    Runs all primary user deployment scripts
+    Runs all primary user deployment scripts, run check_system_tuning once
+    the server is back from the restart at the end
     """
+    # Install the packages for every task at once
+    install_packages()
+
     # Advanced Setup
     make_ssl_keys()
-    install_postgres()
+    if ds.db_node_ip:
+        with settings(host_string='%s@%s' % (ds.username_main, ds.db_node_ip)):
+            setup_db_node()
+    else:
+        install_postgres()
     install_mail_system()
     install_nginx()
     install_python()
@@ -53,6 +134,7 @@ def full_deploy():
     configure_local_workspace()
     setup_production_code()
     setup_bash_aliases()
+    setup_metrics_agent()
     restart()
 
 
@@ -152,18 +234,23 @@ def setup_users():
 
 
 @hosts('root@%s' % ds.ip_address)
-def setup_firewall():
+def setup_firewall(role='front'):
     """
-    Setup iptables firewall with basic security settings
+    Setup iptables firewall with basic security settings. The role of the
+    node ('front', 'app' or 'db') decides which private network ports are
+    opened to the other nodes.
     """
     
     # Updload firewall rules file
-    put('config/iptables.firewall.rules', '/etc')
-    # Load firewall rules
-    run('iptables-restore < /etc/iptables.firewall.rules')
+    upload_config('/etc', 'iptables.firewall.rules', {
+        'trusted_ports': firewall_trusted_ports(role),
+    })
+    # Check and load firewall rules, iptables-restore on 14.04 needs the
+    # newline after COMMIT, which is why the template ends in a blank line
+    sudo('iptables-restore --test < /etc/iptables.firewall.rules')
+    sudo('iptables-restore < /etc/iptables.firewall.rules')
     # Load startup file
-    put('config/firewall', '/etc/network/if-pre-up.d')
-    run('chmod +x /etc/network/if-pre-up.d/firewall')
+    upload_config('/etc/network/if-pre-up.d', 'firewall', {}, permissions='755')
     do_git_commit('setup_firewall')
 
 
@@ -177,6 +264,96 @@ def setup_fail2ban():
     # Not necessary to commit because install_software already does
 
 
+@hosts('root@%s' % ds.ip_address)
+def setup_system_tuning(role='front'):
+    """
+    Tune kernel network, file and memory settings and the open file limits of
+    the service users to match the host resources and the services of the
+    node role ('front', 'app' or 'db')
+    """
+
+    tuning = system_tuning(role)
+
+    # Kernel settings, loaded now and on every boot from sysctl.d
+    upload_config('/etc/sysctl.d', 'sysctl_tuning.conf', dict(tuning,
+        server_name=ds.server_name,
+        domain=ds.domain,
+    ), rename='60-pyserver.conf')
+    sudo('sysctl -p /etc/sysctl.d/60-pyserver.conf')
+
+    # Open file limits for login sessions and for systemd managed services
+    upload_config('/etc/security/limits.d', 'limits_tuning.conf', dict(tuning,
+        server_name=ds.server_name,
+        domain=ds.domain,
+    ), rename='60-pyserver.conf')
+    if ds.ubuntu_version > 14:
+        config_edit('/etc/systemd/system.conf',
+            '^#\\?DefaultLimitNOFILE=.*$',
+            'DefaultLimitNOFILE=%d' % tuning['nofile'])
+
+    # Add swap space to hosts that are short on memory
+    if ds.swap_type and tuning['mem_mb'] < ds.swap_low_memory_mb:
+        swap_size = ds.swap_size_mb or tuning['mem_mb']
+        if ds.swap_type == 'zram':
+            install_software(['zram-config'], update_repo=False)
+            sudo('service zram-config start', warn_only=True)
+        elif sudo('test -f /swapfile', warn_only=True).failed:
+            sudo('fallocate -l %dM /swapfile' % swap_size)
+            sudo('chmod 600 /swapfile')
+            sudo('mkswap /swapfile')
+            sudo('swapon /swapfile')
+            sudo('echo "/swapfile none swap sw 0 0" >> /etc/fstab')
+
+    do_git_commit('setup_system_tuning')
+
+
+@hosts('%s@%s' % (ds.username_main, ds.ip_address))
+def check_system_tuning(role='front'):
+    """
+    Check that the settings from setup_system_tuning are in effect. Run this
+    after full_deploy once the server is back from its restart, the services
+    only pick up their open file limits when they are started again.
+    """
+
+    tuning = system_tuning(role)
+    failed = []
+
+    # Kernel settings
+    for (key, value) in tuning['sysctl_values']:
+        actual = ' '.join(run('sysctl -n %s' % key).split())
+        if actual != str(value):
+            failed.append('%s is %s, expected %s' % (key, actual, value))
+
+    # Service users, the limits.d file applies to their logins
+    for user in tuning['service_users']:
+        if run('id -u %s' % user, warn_only=True).failed:
+            failed.append('user %s does not exist' % user)
+
+    # Open file limit of the running services, the newest process is used
+    # because nginx only raises the limit of its workers
+    for (service, process) in tuning['service_processes']:
+        pid = run('pgrep -n -x %s' % process, warn_only=True)
+        if pid.failed:
+            failed.append('%s is not running' % service)
+            continue
+        actual = sudo("awk '/^Max open files/ {print $4}' /proc/%s/limits" % pid.strip())
+        if actual.strip() != str(tuning['nofile']):
+            failed.append('nofile for %s is %s, expected %d' %
+                          (service, actual.strip(), tuning['nofile']))
+
+    # Swap space
+    if ds.swap_type and tuning['mem_mb'] < ds.swap_low_memory_mb:
+        if run('tail -n +2 /proc/swaps').strip() == '':
+            failed.append('no swap space is active')
+
+    if failed:
+        for message in failed:
+            warn(message)
+    else:
+        puts('System tuning is in effect')
+    return not failed
+
+
 @hosts('root@%s' % ds.ip_address)
 def remove_root_login():
     """
@@ -199,10 +376,61 @@ def restart():
     sudo('reboot')
 
 
+@hosts('%s@%s' % (ds.username_main, ds.ip_address))
+def install_packages(*tasks):
+    """
+    Installs the packages needed by the given deployment tasks (all of the
+    full_deploy tasks by default) in a single apt transaction. Packages are
+    taken from the local package cache when ds.package_cache_dir is set.
+    """
+    tasks = tasks or deploy_package_tasks
+
+    # Collect the packages and installation answers for all the tasks
+    pkg_list = []
+    selections = []
+    for task in tasks:
+        pkg_list += [pkg for pkg in package_manifest.get(task, []) if pkg not in pkg_list]
+        selections += debconf_manifest.get(task, [])
+
+    set_debconf_selections(selections)
+    if ds.package_cache_dir:
+        upload_package_cache()
+    install_software(pkg_list)
+
+
+@hosts('%s@%s' % (ds.username_main, ds.ip_address))
+def fetch_package_cache(*tasks):
+    """
+    Downloads the packages needed by the given deployment tasks (all of the
+    full_deploy tasks by default) into ds.package_cache_dir, so that they
+    only have to be fetched from the mirrors once for all servers
+    """
+    if not ds.package_cache_dir:
+        abort('Set package_cache_dir in deploy_settings to fetch a package cache')
+    tasks = tasks or deploy_package_tasks
+
+    pkg_list = []
+    for task in tasks:
+        pkg_list += [pkg for pkg in package_manifest.get(task, []) if pkg not in pkg_list]
+
+    # Only packages that are not installed yet get downloaded, so start clean
+    sudo('apt-get clean')
+    sudo('DEBIAN_FRONTEND=noninteractive apt-get install -y --download-only %s' % ' '.join(pkg_list))
+    if sudo('ls /var/cache/apt/archives/*.deb', warn_only=True, quiet=True).failed:
+        warn('Nothing was downloaded, the packages are already installed on this '
+             'server. Fetch the cache from a freshly set up server instead.')
+        return
+    local('mkdir -p %s' % ds.package_cache_dir)
+    get('/var/cache/apt/archives/*.deb', local_path=ds.package_cache_dir)
+
+
 @hosts('%s@%s' % (ds.username_main, ds.ip_address))
 def make_ssl_keys():
     """
-    Creates a security keys, certificates and a group with permissions
+    Creates a security keys, certificates and a group with permissions.
+
+    The key is ECDSA (P-256) by default for cheaper handshakes, set
+    ds.ssl_key_type to 'rsa' for clients that can't use it.
     """
     # Create directory for public certs
     sudo('mkdir /etc/ssl/universal', warn_only=True)
@@ -214,9 +442,12 @@ def make_ssl_keys():
     sudo('addgroup secured')
 
     # Create keys and certificates needed for https, and email
-    sudo('openssl genrsa -out private.key 1024')
-    sudo('openssl rsa -in private.key -out public.key -pubout -outform PEM')
-    sudo('openssl req -new -key private.key -out server.csr')
+    if ds.ssl_key_type == 'rsa':
+        sudo('openssl genrsa -out private.key %d' % ds.ssl_rsa_bits)
+    else:
+        sudo('openssl ecparam -name prime256v1 -genkey -noout -out private.key')
+    sudo('openssl pkey -in private.key -out public.key -pubout -outform PEM')
+    sudo('openssl req -new -key private.key -out server.csr -subj "/CN=%s"' % ds.domain)
     sudo('openssl x509 -req -days 3650 -in server.csr -signkey private.key -out server.crt')
 
     # Download a copy of the public key
@@ -242,11 +473,7 @@ def install_postgres():
     """
     
     # Install postgres
-    install_software([
-        'postgresql-%s' % ds.postgres_version,
-        'postgresql-contrib-%s' % ds.postgres_version,
-        'postgresql-server-dev-%s' % ds.postgres_version,
-    ])
+    install_software(package_manifest['install_postgres'])
     # Install the adminpack extension
     sudo('psql -c "CREATE EXTENSION adminpack"', user='postgres')
     # Create a django database user
@@ -269,6 +496,71 @@ def install_postgres():
     
     do_git_commit('install_postgres')
 
+@hosts('%s@%s' % (ds.username_main, ds.ip_address))
+def backup_database(database='production'):
+    """
+    Dumps the production (or test) database into a new directory under
+    ds.backup_dir on the local machine and returns its path.
+
+    pg_dump runs locally with parallel jobs through an ssh tunnel, so the
+    compressed dump is streamed straight to local storage and nothing is
+    staged on the server's disk. The local pg_dump must be at least the
+    version of the server.
+    """
+    db_name, db_user, db_password = db_credentials(database)
+    jobs = ds.backup_jobs or probe_host_resources()[0]
+
+    local('mkdir -p %s' % ds.backup_dir)
+    backup_path = path.join(ds.backup_dir, '%s_%s' % (db_name, strftime('%Y%m%d_%H%M%S')))
+
+    open_db_tunnel()
+    try:
+        start = time()
+        local('PGPASSWORD="%s" pg_dump -h localhost -p %d -U %s -Fd -j %d -Z %d -f %s %s' %
+              (db_password, ds.db_tunnel_port, db_user, jobs, ds.backup_compression, backup_path, db_name))
+    finally:
+        close_db_tunnel()
+    report_throughput('Dumped %s' % db_name, backup_path, time() - start)
+
+    return backup_path
+
+
+@hosts('%s@%s' % (ds.username_main, ds.ip_address))
+def restore_database(backup_path, database='production'):
+    """
+    Restores a directory format dump made by backup_database into the
+    production (or test) database, with parallel pg_restore jobs running
+    locally through an ssh tunnel
+    """
+    db_name, db_user, db_password = db_credentials(database)
+    jobs = ds.backup_jobs or probe_host_resources()[0]
+
+    if database == 'production' and not confirm('Replace the contents of %s?' % db_name, default=False):
+        abort('Restore cancelled')
+
+    open_db_tunnel()
+    try:
+        start = time()
+        local('PGPASSWORD="%s" pg_restore -h localhost -p %d -U %s -Fd -j %d '
+              '--clean --if-exists --no-owner --no-privileges -d %s %s' %
+              (db_password, ds.db_tunnel_port, db_user, jobs, db_name, backup_path))
+    finally:
+        close_db_tunnel()
+    report_throughput('Restored %s' % db_name, backup_path, time() - start)
+
+
+@hosts('%s@%s' % (ds.username_main, ds.ip_address))
+def refresh_test_db():
+    """
+    Replaces the test database with a fresh copy of the production database
+    """
+    if not ds.local_test_db:
+        abort('There is no test database, see local_test_db in deploy_settings')
+
+    backup_path = backup_database()
+    restore_database(backup_path, database='test')
+
+
 @hosts('%s@%s' % (ds.username_main, ds.ip_address))
 def install_mail_system():
     """
@@ -279,15 +571,10 @@ def install_mail_system():
     (http://superuser.com/questions/605521/the-simplest-way-to-set-up-a-secure-imap-email-server)
     """
 
-    # Set the initial configuration options for installation
-    # Postfix
-    sudo('debconf-set-selections <<< "postfix postfix/mailname string %s"' % ds.domain)
-    sudo('debconf-set-selections <<< "postfix postfix/main_mailer_type string \'Internet Site\'"')
-    # Dovecot
-    sudo('debconf-set-selections <<< "dovecot-core dovecot-core/create-ssl-cert string false"')
-
-    # Install the required software
-    install_software(['postfix', 'dovecot-imapd', 'opendkim', 'opendkim-tools'])
+    # Set the initial configuration options for postfix and dovecot and
+    # install the required software
+    set_debconf_selections(debconf_manifest['install_mail_system'])
+    install_software(package_manifest['install_mail_system'])
 
     # Add postfix and dovecot to the secured group
     sudo('usermod -G secured postfix')
@@ -296,9 +583,7 @@ def install_mail_system():
 
     # Configure Postfix
     # Upload the "cleaned up" configuration
-    upload_config('/etc/postfix', 'main.cf', {
-        'domain': ds.domain,
-    })
+    upload_postfix_main_cf()
     # Uncomment certain lines in the master.cf
     config_edit('/etc/postfix/master.cf', 
         '^.*syslog_name.*$', 
@@ -329,7 +614,11 @@ def install_mail_system():
         '^.*mail_location.*$',
         'mail_location = maildir:~/Mail')
     upload_config('/etc/dovecot/conf.d', '10-master.conf', {})
-    upload_config('/etc/dovecot/conf.d', '10-ssl.conf', {})
+    # ssl_min_protocol replaced ssl_protocols in dovecot 2.3
+    dovecot_version = [int(part) for part in run('dovecot --version').split()[0].split('.')[:2]]
+    upload_config('/etc/dovecot/conf.d', '10-ssl.conf', dict(tls_profile(),
+        dovecot_min_protocol=dovecot_version >= [2, 3],
+    ))
 
     # Create a DKIM key
     sudo('mkdir /etc/ssl/mail', warn_only=True)
@@ -351,10 +640,110 @@ def install_mail_system():
     sudo('service dovecot restart')
     sudo('service opendkim restart')
     sudo('service postfix restart')
+
+    # Spam filtering
+    if ds.use_spamassassin:
+        setup_spamassassin()
     
     #do_git_commit("install_mail_system")
 
 
+@hosts('%s@%s' % (ds.username_main, ds.ip_address))
+def setup_spamassassin():
+    """
+    Installs SpamAssassin and hooks it into postfix as a milter next to
+    OpenDKIM. spamd keeps a pool of pre-forked children, sized from the host
+    cores and memory, that spamass-milter hands each message to. Mail from
+    authenticated users (submission) is not scanned.
+    """
+    install_software(package_manifest['setup_spamassassin'])
+
+    # Each child uses about 60MB, let them have at most a quarter of memory
+    cores, mem_mb = probe_host_resources()
+    max_children = max(2, min(cores * 2, mem_mb // 4 // 60))
+    min_children = max(1, max_children // 2)
+
+    # Configure spamd
+    upload_config('/etc/default', 'spamassassin', {
+        'cores': cores,
+        'mem_mb': mem_mb,
+        'min_children': min_children,
+        'max_children': max_children,
+        'min_spare': 1,
+        'max_spare': min_children,
+    })
+    upload_config('/etc/spamassassin', 'local.cf', {
+        'domain': ds.domain,
+        'spam_required_score': ds.spam_required_score,
+        'spam_bayes_store': ds.spam_bayes_store,
+    })
+    if ds.spam_bayes_store != 'redis':
+        sudo('mkdir -p /var/lib/spamassassin/bayes', warn_only=True)
+        sudo('chown debian-spamd:debian-spamd /var/lib/spamassassin/bayes')
+        sudo('chmod 770 /var/lib/spamassassin/bayes')
+
+    # Configure the milter and add it to postfix
+    upload_config('/etc/default', 'spamass-milter', {
+        'spam_reject_score': ds.spam_reject_score,
+        'spam_max_size': ds.spam_max_size,
+    })
+    upload_postfix_main_cf()
+
+    # Restart programs
+    if ds.ubuntu_version > 14:
+        sudo('systemctl enable spamassassin')
+    sudo('service spamassassin restart')
+    sudo('service spamass-milter restart')
+    sudo('service postfix reload')
+
+    do_git_commit('setup_spamassassin')
+
+
+def benchmark_spam(corpus_dir, concurrency=4):
+    """
+    Sends every message in the local corpus_dir to the mail user over SMTP
+    and reports messages per second and the latency of each message, which
+    includes the milters. The messages end up in the mail user's inbox,
+    messages rejected as spam are counted and timed as well.
+    """
+    recipient = '%s@%s' % (ds.username_email, ds.domain)
+    messages = [path.join(corpus_dir, name) for name in sorted(listdir(corpus_dir))]
+    if not messages:
+        abort('No messages in %s' % corpus_dir)
+
+    def send(message_file):
+        with open(message_file, 'rb') as fh:
+            message = fh.read()
+        start = time()
+        smtp = SMTP(ds.domain, 25)
+        try:
+            smtp.sendmail('benchmark@%s' % ds.domain, [recipient], message)
+            smtp.quit()
+            accepted = True
+        except SMTPException:
+            # spamass-milter rejects messages above spam_reject_score
+            smtp.close()
+            accepted = False
+        return time() - start, accepted
+
+    pool = ThreadPool(int(concurrency))
+    start = time()
+    results = pool.map(send, messages)
+    elapsed = time() - start
+    pool.close()
+
+    latencies = sorted(latency for (latency, _) in results)
+    count = len(latencies)
+    accepted = len([result for result in results if result[1]])
+    puts('Sent %d messages in %.1fs (%.1f messages/s), %d accepted, %d rejected' % (
+        count, elapsed, count / elapsed, accepted, count - accepted))
+    puts('Latency mean %.0fms, median %.0fms, 95th percentile %.0fms' % (
+        1000 * sum(latencies) / count,
+        1000 * latencies[count // 2],
+        1000 * latencies[int(count * 0.95)],
+    ))
+
+
 @hosts('%s@%s' % (ds.username_main, ds.ip_address))
 def install_nginx():
     """
@@ -362,7 +751,7 @@ def install_nginx():
     """
     
     # Install server software from repository
-    install_software(['nginx-full'])
+    install_software(package_manifest['install_nginx'])
     
     # Create directory for nginx logs
     sudo('mkdir -p /var/log/%s' % ds.domain, warn_only=True)
@@ -370,40 +759,189 @@ def install_nginx():
     # Create a self-signed SSL certificate if required
     if ds.use_https:
         sudo('usermod -G secured www-data')
-        nginx_config_file = 'nginx_settings_ssl'
-        
-    else:
-        nginx_config_file = 'nginx_settings'
             
+    # Size connections and listen backlog to the kernel tuning
+    tuning = system_tuning()
+    config_edit('/etc/nginx/nginx.conf',
+        '^\\(\\s*\\)worker_connections.*$',
+        '\\1worker_connections %d;' % (tuning['nofile'] // 2))
+    if sudo('grep -q "^worker_rlimit_nofile" /etc/nginx/nginx.conf', warn_only=True).failed:
+        config_append('/etc/nginx/nginx.conf', '^worker_processes',
+            ['worker_rlimit_nofile %d;' % tuning['nofile']])
+
+    # Create directory for the microcache
+    if ds.use_microcache:
+        sudo('mkdir -p /var/cache/nginx/%s' % ds.domain, warn_only=True)
+        sudo('chown www-data:www-data /var/cache/nginx/%s' % ds.domain)
+
     # Configure nginx
-    upload_config('/etc/nginx/sites-available', nginx_config_file, {
-        'domain': ds.domain,
-        'app_name': ds.app_name,
-    }, rename=ds.domain)
+    upload_nginx_site()
     
     # enable the site
     sudo('rm /etc/nginx/sites-enabled/default')
     sudo('ln -s /etc/nginx/sites-available/%s /etc/nginx/sites-enabled/%s' % (ds.domain, ds.domain))
 
 
+def benchmark_tls(port=443, seconds=10):
+    """
+    Measures full and resumed TLS handshakes per second against the server
+    from the local machine. Use port 993 for IMAPS.
+    """
+    for (description, option) in [('Full handshakes', '-new'), ('Resumed handshakes', '-reuse')]:
+        result = local('openssl s_time -connect %s:%s %s -time %s 2>&1 | grep "connections/user sec"' %
+                       (ds.domain, port, option, seconds), capture=True)
+        puts('%s: %s' % (description, result.strip()))
+
+
 @hosts('%s@%s' % (ds.username_main, ds.ip_address))
-def install_python():
+def microcache_stats():
     """
-    Install Python and desired packages in a virtualenv at /var/venv
+    Reports the nginx microcache hit ratio from the access log
+    """
+    result = sudo("awk '{print $NF}' /var/log/%s/nginx_access.log | sort | uniq -c" % ds.domain)
+
+    counts = {}
+    for line in result.splitlines():
+        fields = line.split()
+        if len(fields) == 2:
+            counts[fields[1]] = int(fields[0])
+
+    # Requests that were looked up in the cache, BYPASS is logged in users
+    cached = ['HIT', 'STALE', 'UPDATING', 'REVALIDATED']
+    looked_up = cached + ['MISS', 'EXPIRED']
+    hits = sum(counts.get(status, 0) for status in cached)
+    total = sum(counts.get(status, 0) for status in looked_up)
+    for status in looked_up + ['BYPASS']:
+        puts('%-12s %d' % (status, counts.get(status, 0)))
+    puts('Hit ratio: %.1f%% of %d cacheable requests' % (100.0 * hits / max(total, 1), total))
+
+
+@hosts('%s@%s' % (ds.username_main, ds.ip_address))
+def purge_microcache():
+    """
+    Empties the nginx microcache, so that a deploy is visible straight away
+    """
+    sudo('find /var/cache/nginx/%s -type f -delete' % ds.domain, warn_only=True)
+
+
+@hosts('%s@%s' % (ds.username_main, ds.ip_address))
+def add_app_node(public_ip, private_ip):
+    """
+    Provisions a new app node running uWSGI and adds it to the nginx upstream
+    on the front node with a graceful reload. Run full_setup on the new node
+    first (fab full_setup:hosts=root@{public_ip}).
+    """
+    check_private_network()
+    app_host = '%s@%s' % (ds.username_main, public_ip)
+    save_app_node(public_ip, private_ip)
+
+    # Let the app node fetch the code from the repository on the front node
+    with settings(host_string=app_host):
+        app_key = run('cat ~/.ssh/id_%s.pub' % ds.ssh_keytype)
+    app_key = app_key.strip()
+    if sudo('grep -q -x -F "%s" /home/git/.ssh/authorized_keys' % app_key, warn_only=True).failed:
+        sudo('echo "%s" >> /home/git/.ssh/authorized_keys' % app_key)
+
+    # Let the app node use the database
+    with settings(host_string='%s@%s' % (ds.username_main, ds.db_node_ip or ds.ip_address)):
+        setup_firewall('db' if ds.db_node_ip else 'front')
+        allow_db_client(private_ip)
+
+    # Provision the app node
+    with settings(host_string=app_host):
+        setup_firewall('app')
+        setup_system_tuning('app')
+        install_packages('install_python', 'setup_repo')
+        install_python(private_ip)
+        setup_production_code(app_node=True)
+        sudo('service uwsgi restart || service uwsgi start')
+        setup_metrics_agent('app')
+
+    # Only add the node once uWSGI answers the front node
+    listening = run('for try in $(seq 10); do nc -z -w 2 %s %d && exit 0; sleep 1; done; exit 1' %
+                    (private_ip, ds.uwsgi_port), warn_only=True)
+    if listening.failed:
+        # Take back the access given to the node above
+        remove_app_node(public_ip)
+        sudo('grep -v -x -F "%s" /home/git/.ssh/authorized_keys > /tmp/authorized_keys; '
+             'cat /tmp/authorized_keys > /home/git/.ssh/authorized_keys; rm /tmp/authorized_keys' % app_key)
+        with settings(host_string='%s@%s' % (ds.username_main, ds.db_node_ip or ds.ip_address)):
+            setup_firewall('db' if ds.db_node_ip else 'front')
+            deny_db_client(private_ip)
+        abort('uWSGI on %s is not answering on %s:%d, see /var/log/%s/uwsgi.log on the node' %
+              (public_ip, private_ip, ds.uwsgi_port, ds.domain))
+
+    # Add it to the upstream without dropping connections
+    upload_nginx_site()
+    sudo('nginx -t && service nginx reload')
+
+
+@hosts('%s@%s' % (ds.username_main, ds.db_node_ip or ds.ip_address))
+def setup_db_node():
+    """
+    Installs postgres on the separate database node (ds.db_node_ip) and lets
+    the front node connect to it. Run full_setup on the node first
+    (fab full_setup:hosts=root@{db_node_ip}), full_deploy runs this task.
+    """
+    if not ds.db_node_ip:
+        abort('Set db_node_ip in deploy_settings to use a separate database node')
+    check_private_network()
+
+    setup_firewall('db')
+    setup_system_tuning('db')
+    install_packages('install_postgres')
+    install_postgres()
+    allow_db_client(ds.private_ip_address)
+    setup_metrics_agent('db')
+
+
+@hosts('%s@%s' % (ds.username_main, ds.db_node_ip or ds.ip_address))
+def allow_db_client(private_ip):
+    """
+    Lets the Django database users connect to postgres from another node on
+    the private network
+    """
+    pg_dir = '/etc/postgresql/%s/main' % ds.postgres_version
+
+    if sudo('grep -q "%s/32" %s/pg_hba.conf' % (private_ip, pg_dir), warn_only=True).failed:
+        config_append('%s/pg_hba.conf' % pg_dir,
+            '^\s*#\s*TYPE\s*DATABASE\s*USER\s*ADDRESS\s*METHOD\s*$',
+            ['host  all  %s  %s/32  md5' % (ds.django_db_user, private_ip),
+             'host  all  %s  %s/32  md5' % (ds.django_db_test_user, private_ip)])
+
+    # Listening on new addresses needs a restart, new clients only a reload
+    if sudo("grep -q \"^listen_addresses = '\\*'\" %s/postgresql.conf" % pg_dir, warn_only=True).failed:
+        sudo("sed -i \"s|^#\\?listen_addresses.*$|listen_addresses = '*'|\" %s/postgresql.conf" % pg_dir)
+        sudo('service postgresql restart')
+    else:
+        sudo('service postgresql reload')
+
+    do_git_commit('allow_db_client: %s' % private_ip)
+
+
+@hosts('%s@%s' % (ds.username_main, ds.db_node_ip or ds.ip_address))
+def deny_db_client(private_ip):
+    """
+    Removes the postgres access that allow_db_client gave to a node
+    """
+    pg_dir = '/etc/postgresql/%s/main' % ds.postgres_version
+
+    sudo('sed -i "/\\s%s\\/32\\s/d" %s/pg_hba.conf' % (private_ip.replace('.', '\\.'), pg_dir))
+    sudo('service postgresql reload')
+
+    do_git_commit('deny_db_client: %s' % private_ip)
+
+
+@hosts('%s@%s' % (ds.username_main, ds.ip_address))
+def install_python(private_ip=None):
+    """
+    Install Python and desired packages in a virtualenv at /var/venv. On app
+    nodes uWSGI listens on ds.uwsgi_port of the given private address instead
+    of a unix socket.
     """
     
     # Get the required software
-    install_software([
-        'python%s-dev' % ds.python_version,
-        'libpcre3-dev',
-        'libssl-dev',
-        'gfortran',
-        'libopenblas-dev',
-        'liblapack-dev',
-        'libfreetype6-dev',
-        'libxft-dev',
-        'python-virtualenv'
-    ])
+    install_software(package_manifest['install_python'])
     
     # Make a virtual environment for the user and activate it
     sudo('mkdir -p /var/venv', warn_only=True)
@@ -430,10 +968,21 @@ def install_python():
             sudo(python_env + 'pip install sympy', user=ds.username_main, group='www-data')
             sudo(python_env + 'pip install django-treebeard', user=ds.username_main, group='www-data')
         
+    # Create directory for uWSGI logs
+    sudo('mkdir -p /var/log/%s' % ds.domain, warn_only=True)
+
     # Create Upstart file to run uWSGI
+    tuning = system_tuning()
+    if private_ip:
+        uwsgi_socket = '%s:%d' % (private_ip, ds.uwsgi_port)
+    else:
+        uwsgi_socket = '/tmp/%s.sock' % ds.app_name
     upload_config('/etc/init', 'uwsgi.conf', {
         'app_name': ds.app_name,
         'domain': ds.domain,
+        'uwsgi_socket': uwsgi_socket,
+        'listen_backlog': tuning['listen_backlog'],
+        'nofile': tuning['nofile'],
     })
 
 
@@ -443,7 +992,7 @@ def setup_repo():
     Sets up a git repository where the website code can live and be deployed from
     """
     # Install git
-    install_software(['git'])
+    install_software(package_manifest['setup_repo'])
 
     # Set up a directory
     sudo('mkdir -p /home/git/%s.git' % ds.domain, user='git', warn_only=True)
@@ -502,6 +1051,7 @@ def configure_local_workspace():
             'django_db_name': ds.django_db_test_name,
             'django_db_user': ds.django_db_test_user,
             'django_db_pwd': random_password('DJANGO TEST DATABASE'),
+            'django_db_host': database_host(),
             'username_email': ds.username_email,
             'password_email': random_password('MAIL USER'),
         }, rename="secrets.py", user=ds.username_main, permissions='600')
@@ -518,10 +1068,12 @@ def configure_local_workspace():
 
 
 @hosts('%s@%s' % (ds.username_main, ds.ip_address))
-def setup_production_code():
+def setup_production_code(app_node=False):
     """
-    Sets up production code on the server
+    Sets up production code on the server, app nodes fetch it from the
+    repository on the front node
     """
+    repo_host = ds.private_ip_address if app_node else 'localhost'
 
     # Deploy to webserver domain (via tutorial at
     # http://grimoire.ca/git/stop-using-git-pull-to-deploy)
@@ -529,8 +1081,8 @@ def setup_production_code():
     sudo('chown -R %s:www-data /var/www' % ds.username_main)
     with cd('/var/www/%s' % ds.domain):
         sudo('git init', user=ds.username_main, group='www-data')
-        sudo('git remote add origin git@localhost:/home/git/%s.git' %
-             ds.domain, user=ds.username_main, group='www-data')
+        sudo('git remote add origin git@%s:/home/git/%s.git' %
+             (repo_host, ds.domain), user=ds.username_main, group='www-data')
         sudo('git fetch --all', user=ds.username_main, group='www-data')
         sudo('git checkout --force "origin/master"', user=ds.username_main, group='www-data')
 
@@ -542,6 +1094,7 @@ def setup_production_code():
             'django_db_name': ds.django_db_name,
             'django_db_user': ds.django_db_user,
             'django_db_pwd': random_password('DJANGO DATABASE'),
+            'django_db_host': database_host(app_node),
             'username_email': ds.username_email,
             'password_email': random_password('MAIL USER'),
         }, rename="secrets.py", user=ds.username_main, group='www-data', permissions='640')
@@ -558,6 +1111,129 @@ def setup_production_code():
             sudo(python_env + 'python %s/manage.py collectstatic' %
                  ds.app_name, user=ds.username_main, group='www-data')
 
+    # Don't serve pages of the previous code from the cache
+    if ds.use_microcache:
+        purge_microcache()
+
+
+@hosts('%s@%s' % (ds.username_main, ds.ip_address))
+def setup_metrics_agent(role='front'):
+    """
+    Deploys the metrics agent, which samples cpu, memory, disk IO, the memory
+    of each service, postgres activity and the mail queue into a fixed size
+    ring file on the server. The role of the node ('front', 'app' or 'db')
+    decides which services are sampled. Use collect_metrics to read it.
+    """
+    services = node_services(role)
+
+    # Processes of the services running on this host, by /proc/<pid>/comm
+    service_processes = []
+    if 'web' in services:
+        service_processes += [('nginx', ['nginx']), ('uwsgi', ['uwsgi'])]
+    if 'postgres' in services:
+        service_processes += [('postgres', ['postgres'])]
+    if 'mail' in services:
+        service_processes += [
+            ('postfix', ['master', 'qmgr', 'pickup', 'smtpd', 'smtp', 'cleanup', 'trivial-rewrite',
+                         'local', 'bounce', 'tlsmgr', 'proxymap', 'showq', 'scache']),
+            ('dovecot', ['dovecot', 'imap', 'imap-login', 'auth', 'config', 'log']),
+            ('opendkim', ['opendkim']),
+        ]
+        if ds.use_spamassassin:
+            service_processes += [('spamassassin', ['/usr/sbin/spamd', 'spamd child', 'spamass-milter'])]
+
+    sudo('mkdir -p %s' % path.dirname(metrics_ring_file), warn_only=True)
+    upload_config('/usr/local/bin', 'metrics_agent.py', {
+        'server_name': ds.server_name,
+        'domain': ds.domain,
+        'ring_file': metrics_ring_file,
+        'ring_header': metrics_ring_header,
+        'ring_magic': metrics_ring_magic,
+        'capacity': ds.metrics_capacity,
+        'interval': ds.metrics_interval,
+        'service_processes': service_processes,
+        'use_postgres': 'postgres' in services,
+        'use_mail': 'mail' in services,
+        'db_name': ds.django_db_name,
+        'db_user': ds.django_db_user,
+        'db_password': random_password('DJANGO DATABASE'),
+    }, rename='pyserver-metrics', permissions='700')
+
+    # Create an Upstart job or systemd unit to run the agent
+    if ds.ubuntu_version <= 14:
+        upload_config('/etc/init', 'metrics_agent.conf', {}, rename='pyserver-metrics.conf')
+        sudo('service pyserver-metrics restart || service pyserver-metrics start')
+    else:
+        upload_config('/etc/systemd/system', 'metrics_agent.service', {}, rename='pyserver-metrics.service')
+        sudo('systemctl daemon-reload')
+        sudo('systemctl enable pyserver-metrics')
+        sudo('systemctl restart pyserver-metrics')
+
+
+@hosts('%s@%s' % (ds.username_main, ds.ip_address))
+def collect_metrics(nodes=None, bucket=60):
+    """
+    Downloads the metrics ring files of the given nodes (separated by ';',
+    all known nodes by default) to info/metrics, prints the mean and peak of
+    every value for each node and writes them averaged into time aligned
+    buckets of the given seconds to info/metrics/summary.csv. Nodes without
+    the agent are skipped with a warning.
+    """
+    if nodes:
+        nodes = nodes.split(';')
+    else:
+        nodes = [ds.ip_address] + sorted(load_app_nodes()) + ([ds.db_node_ip] if ds.db_node_ip else [])
+    bucket = int(bucket)
+
+    # Fetch and read the ring file of each node
+    local('mkdir -p info/metrics')
+    rings = {}
+    for node in nodes:
+        local_file = 'info/metrics/%s.ring' % node
+        with settings(host_string='%s@%s' % (ds.username_main, node), warn_only=True):
+            fetched = get(metrics_ring_file, local_path=local_file, use_sudo=True)
+        if fetched.failed:
+            warn('No metrics on %s, deploy the agent with setup_metrics_agent' % node)
+            continue
+        rings[node] = read_metrics_ring(local_file)
+    nodes = [node for node in nodes if node in rings]
+    if not nodes:
+        abort('No metrics were collected')
+
+    # Mean and peak of each value per node, NaN values are missing readings
+    aligned = {}
+    for node in nodes:
+        (fields, samples) = rings[node]
+        puts('%s: %d samples' % (node, len(samples)))
+        rss = []
+        for (idx, field) in enumerate(fields[1:], 1):
+            column = [sample[idx] for sample in samples if sample[idx] == sample[idx]]
+            if not column:
+                continue
+            mean = sum(column) / len(column)
+            puts('    %-24s mean %10.1f    peak %10.1f' % (field, mean, max(column)))
+            if field.startswith('rss_mb:'):
+                rss.append((mean, field.split(':', 1)[1]))
+        if rss:
+            puts('    Most memory: %s' % ', '.join('%s %.0fMB' % (service, mean) for (mean, service) in sorted(rss, reverse=True)))
+
+        for sample in samples:
+            start = int(sample[0]) // bucket * bucket
+            for (idx, field) in enumerate(fields[1:], 1):
+                if sample[idx] == sample[idx]:
+                    aligned.setdefault(start, {}).setdefault((node, field), []).append(sample[idx])
+
+    # One row per time bucket, one column per node and value
+    columns = [(node, field) for node in nodes for field in rings[node][0][1:]]
+    with open('info/metrics/summary.csv', 'w') as fh:
+        writer = csv.writer(fh)
+        writer.writerow(['time'] + ['%s %s' % column for column in columns])
+        for start in sorted(aligned):
+            values = [aligned[start].get(column) for column in columns]
+            writer.writerow([strftime('%Y-%m-%d %H:%M:%S', localtime(start))] +
+                            ['%.2f' % (sum(value) / len(value)) if value else '' for value in values])
+    puts('Time aligned summary written to info/metrics/summary.csv')
+
 
 @hosts('%s@%s' % (ds.username_main, ds.ip_address))
 def setup_bash_aliases():
@@ -568,9 +1244,126 @@ def setup_bash_aliases():
         'domain': ds.domain,
         'username_main': ds.username_main,
         'app_name': ds.app_name,
+        'use_microcache': ds.use_microcache,
     }, user=ds.username_main)
             
 
+def upload_postfix_main_cf():
+    """
+    Renders the postfix main.cf, with the milters of the enabled filters
+    """
+    upload_config('/etc/postfix', 'main.cf', dict(tls_profile(),
+        domain=ds.domain,
+        use_spamassassin=ds.use_spamassassin,
+    ))
+
+def upload_nginx_site():
+    """
+    Renders the nginx site for the domain, with an upstream of the uWSGI
+    socket on this node or of all the app nodes
+    """
+    if ds.use_https:
+        nginx_config_file = 'nginx_settings_ssl'
+    else:
+        nginx_config_file = 'nginx_settings'
+
+    app_nodes = load_app_nodes()
+    if app_nodes:
+        upstream_servers = ['%s:%d' % (private_ip, ds.uwsgi_port) for private_ip in sorted(app_nodes.values())]
+    else:
+        upstream_servers = ['unix:///tmp/%s.sock' % ds.app_name]
+
+    tuning = system_tuning()
+    upload_config('/etc/nginx/sites-available', nginx_config_file, dict(tls_profile(),
+        domain=ds.domain,
+        app_name=ds.app_name,
+        upstream_servers=upstream_servers,
+        listen_backlog=tuning['listen_backlog'],
+        use_microcache=ds.use_microcache,
+        microcache_size_mb=ds.microcache_size_mb,
+        microcache_keys_mb=max(1, ds.microcache_size_mb // 16),
+        microcache_ttl=ds.microcache_ttl,
+        modern_nginx=ds.ubuntu_version > 14,
+    ), rename=ds.domain)
+
+def load_app_nodes():
+    """
+    Returns the app nodes added with add_app_node as {public ip: private ip}
+    """
+    try:
+        with open('info/app_nodes.json', 'r') as fh:
+            return json.load(fh)
+    except IOError:
+        return {}
+
+def save_app_node(public_ip, private_ip):
+    """
+    Adds an app node to the saved list of app nodes
+    """
+    app_nodes = load_app_nodes()
+    app_nodes[public_ip] = private_ip
+    with open('info/app_nodes.json', 'w') as fh:
+        json.dump(app_nodes, fh, indent=4)
+
+def remove_app_node(public_ip):
+    """
+    Removes an app node from the saved list of app nodes
+    """
+    app_nodes = load_app_nodes()
+    app_nodes.pop(public_ip, None)
+    with open('info/app_nodes.json', 'w') as fh:
+        json.dump(app_nodes, fh, indent=4)
+
+def check_private_network():
+    """
+    Aborts unless the private addresses that the nodes use to reach each
+    other are set in the deploy settings
+    """
+    if not ds.private_ip_address:
+        abort('Set private_ip_address in deploy_settings to the private address of the front node')
+    if ds.db_node_ip and not ds.db_private_ip:
+        abort('Set db_private_ip in deploy_settings to the private address of the database node')
+
+def node_services(role):
+    """
+    Returns the services of ds.services that run on a node with the given
+    role ('front', 'app' or 'db')
+    """
+    if role == 'app':
+        return ['web']
+    elif role == 'db':
+        return ['postgres']
+    elif ds.db_node_ip:
+        return [service for service in ds.services if service != 'postgres']
+    else:
+        return list(ds.services)
+
+def database_host(app_node=False):
+    """
+    Returns the address Django uses to reach postgres
+    """
+    if ds.db_node_ip:
+        return ds.db_private_ip
+    elif app_node:
+        return ds.private_ip_address
+    else:
+        return 'localhost'
+
+def firewall_trusted_ports(role):
+    """
+    Returns (source address, port) pairs that the other nodes on the private
+    network are allowed to connect to on a node with the given role
+    """
+    app_ips = sorted(load_app_nodes().values())
+    if role == 'app':
+        return [(ds.private_ip_address, ds.uwsgi_port)]
+    elif role == 'db':
+        return [(ip, 5432) for ip in [ds.private_ip_address] + app_ips]
+    elif role == 'front' and not ds.db_node_ip:
+        return [(ip, 5432) for ip in app_ips]
+    else:
+        return []
+
 def upload_config(upload_location, local_file, values, rename=None, user='root', group=None, permissions='644'):
     """
     Creates a backup of the original file on the server, fills in the given
@@ -635,7 +1428,8 @@ def random_password(description, min_chars=10, max_chars=20):
 
 def install_software(pkg_list, root=False, update_repo=True):
     """
-    Installs packages in the pkg_list
+    Installs the packages in the pkg_list that are not installed yet in a
+    single non-interactive apt transaction
 
     :param pkg_list: packages to be installed
     :type pkg_list: list
@@ -643,31 +1437,209 @@ def install_software(pkg_list, root=False, update_repo=True):
     :type root: boolean
     """
 
-    # Check to see if packages are already installed
-    install_pkgs = []
-    for pkg in pkg_list:
-        cmd_f = 'dpkg-query -l "%s" | grep -q ^.i'
-        cmd = cmd_f % pkg
-        with settings(warn_only=True):
-            result = run(cmd)
-            is_installed = result.succeeded
-        if not is_installed:
-            install_pkgs.append(pkg)
+    # Check to see if packages are already installed, all in one query
+    with settings(warn_only=True):
+        result = run("dpkg-query -W -f='${Package} ${Status}\\n' %s" % ' '.join(pkg_list))
+    installed = [line.split()[0] for line in result.splitlines()
+                 if line.strip().endswith('install ok installed')]
+    install_pkgs = [pkg for pkg in pkg_list if pkg not in installed]
 
     # Install each package
     if not install_pkgs:
         return
 
     install_str = ' '.join(install_pkgs)
+    install_cmd = 'DEBIAN_FRONTEND=noninteractive apt-get install -y %s' % install_str
     if root:
-        run('apt-get install -y %s' % install_str)
+        run(install_cmd)
     else:
-        sudo('apt-get install -y %s' % install_str)
+        sudo(install_cmd)
 
     # Update the repo if needed
     if update_repo:
         do_git_commit('installed: %s' % install_str)
 
+def probe_host_resources():
+    """
+    Returns the number of cpu cores and the total memory in MB of the host
+    """
+    cores = int(run('nproc'))
+    mem_kb = int(run("awk '/^MemTotal:/ {print $2}' /proc/meminfo"))
+    return cores, mem_kb // 1024
+
+def system_tuning(role='front'):
+    """
+    Works out kernel settings and open file limits from the host resources
+    and the services of the node role
+    """
+    cores, mem_mb = probe_host_resources()
+    services = node_services(role)
+
+    # Connection backlogs, shared by the kernel, nginx and uWSGI
+    somaxconn = 4096 if mem_mb >= 1024 else 1024
+    # Roughly what the kernel would choose on its own, but never too low
+    file_max = max(100000, mem_mb * 100)
+    nofile = min(65536, file_max // 4)
+
+    # Users that the enabled services run as
+    service_users = []
+    if 'web' in services:
+        service_users += ['www-data']
+    if 'postgres' in services:
+        service_users += ['postgres']
+    if 'mail' in services:
+        service_users += ['postfix', 'dovecot', 'opendkim']
+
+    # Services (with their process name) that get the open file limit. nginx
+    # and uWSGI set it themselves, the others only through systemd, so they
+    # keep the default of init on 14.04
+    service_processes = []
+    if 'web' in services:
+        service_processes += [('nginx', 'nginx'), ('uwsgi', 'uwsgi')]
+    if ds.ubuntu_version > 14:
+        if 'postgres' in services:
+            service_processes += [('postgres', 'postgres')]
+        if 'mail' in services:
+            service_processes += [('postfix', 'master'), ('dovecot', 'dovecot'), ('opendkim', 'opendkim')]
+
+    sysctl_values = [
+        ('net.core.somaxconn', somaxconn),
+        ('net.core.netdev_max_backlog', somaxconn),
+        ('net.ipv4.tcp_max_syn_backlog', somaxconn * 2),
+        ('net.ipv4.tcp_tw_reuse', 1),
+        ('net.ipv4.tcp_fin_timeout', 15),
+        ('net.ipv4.tcp_slow_start_after_idle', 0),
+        ('net.ipv4.ip_local_port_range', '10240 65535'),
+        ('fs.file-max', file_max),
+        # Keep the database and app workers in memory as long as possible
+        ('vm.swappiness', 10 if 'postgres' in services else 30),
+        ('vm.vfs_cache_pressure', 50),
+    ]
+
+    return {
+        'cores': cores,
+        'mem_mb': mem_mb,
+        'sysctl_values': sysctl_values,
+        'nofile': nofile,
+        'service_users': service_users,
+        'service_processes': service_processes,
+        'listen_backlog': somaxconn,
+    }
+
+def set_debconf_selections(selections):
+    """
+    Preseeds the answers to package installation questions
+    
+    :param selections: lines in debconf-set-selections format
+    :type selections: list
+    """
+    if not selections:
+        return
+
+    with open('tmp/debconf_selections', 'w') as fh:
+        fh.write('\n'.join(selections) + '\n')
+    put('tmp/debconf_selections', '~')
+    sudo('debconf-set-selections ~/debconf_selections')
+    run('rm ~/debconf_selections')
+
+    if ds.remove_temp_files:
+        local('rm tmp/debconf_selections')
+
+def upload_package_cache():
+    """
+    Uploads the local .deb package cache to the apt archive on the server in
+    a single transfer, apt then installs from it instead of the mirrors
+    """
+    local('tar -C %s -cf tmp/package_cache.tar .' % ds.package_cache_dir)
+    put('tmp/package_cache.tar', '~')
+    sudo('tar -C /var/cache/apt/archives -xf ~/package_cache.tar --no-same-owner')
+    run('rm ~/package_cache.tar')
+
+    if ds.remove_temp_files:
+        local('rm tmp/package_cache.tar')
+
+def db_credentials(database):
+    """
+    Returns the name, user and password of the 'production' or 'test' database
+    """
+    if database == 'production':
+        return ds.django_db_name, ds.django_db_user, random_password('DJANGO DATABASE')
+    elif database == 'test':
+        return ds.django_db_test_name, ds.django_db_test_user, random_password('DJANGO TEST DATABASE')
+    else:
+        abort('Unknown database "%s", use production or test' % database)
+
+def open_db_tunnel():
+    """
+    Forwards ds.db_tunnel_port on the local machine to postgres on the server
+    until close_db_tunnel is called
+    """
+    local('ssh -f -N -M -S tmp/db_tunnel.sock -o ExitOnForwardFailure=yes -L %d:localhost:5432 %s@%s' %
+          (ds.db_tunnel_port, ds.username_main, ds.db_node_ip or ds.ip_address))
+
+def close_db_tunnel():
+    """
+    Closes the tunnel opened by open_db_tunnel and frees its local port
+    """
+    local('ssh -S tmp/db_tunnel.sock -O exit %s@%s' %
+          (ds.username_main, ds.db_node_ip or ds.ip_address))
+
+def report_throughput(description, local_path, seconds):
+    """
+    Prints the size of a local file or directory and the rate it was
+    transferred at
+    """
+    size_mb = int(local('du -sm %s | cut -f1' % local_path, capture=True))
+    puts('%s: %dMB in %.1fs (%.1fMB/s)' % (description, size_mb, seconds, size_mb / max(seconds, 0.001)))
+
+def tls_profile():
+    """
+    Returns the TLS settings shared by nginx, postfix and dovecot
+    """
+    modern = ds.ubuntu_version > 14
+    return {
+        'ssl_key_type': ds.ssl_key_type,
+        'ssl_protocols': 'TLSv1.2 TLSv1.3' if modern else 'TLSv1.2',
+        'ssl_excluded_protocols': ['SSLv2', 'SSLv3', 'TLSv1', 'TLSv1.1'],
+        'ssl_ciphers': ':'.join([
+            'ECDHE-ECDSA-AES128-GCM-SHA256',
+            'ECDHE-RSA-AES128-GCM-SHA256',
+            'ECDHE-ECDSA-CHACHA20-POLY1305',
+            'ECDHE-RSA-CHACHA20-POLY1305',
+            'ECDHE-ECDSA-AES256-GCM-SHA384',
+            'ECDHE-RSA-AES256-GCM-SHA384',
+        ]),
+        'ssl_session_timeout': '1d',
+        'ssl_ocsp_stapling': ds.ssl_ocsp_stapling,
+        # HTTP/2 and session ticket settings need nginx 1.9.5+
+        'modern_tls': modern,
+    }
+
+def read_metrics_ring(filename):
+    """
+    Returns the field names and the samples, oldest first, of a ring file
+    written by the metrics agent
+    """
+    header_size = struct.calcsize(metrics_ring_header)
+    with open(filename, 'rb') as fh:
+        (magic, capacity, field_count, written, names) = struct.unpack(
+            metrics_ring_header, fh.read(header_size))
+        data = fh.read()
+
+    if magic != metrics_ring_magic.encode('ascii'):
+        abort('%s is not a metrics ring file' % filename)
+    fields = names.rstrip(b'\0').decode('ascii').split(',')
+    record = struct.Struct('<%dd' % field_count)
+
+    # Once the ring has wrapped around the oldest sample is the next to be
+    # overwritten
+    count = min(written, capacity)
+    samples = []
+    for idx in range(written - count, written):
+        offset = (idx % capacity) * record.size
+        samples.append(record.unpack(data[offset:offset + record.size]))
+    return fields, samples
+
 def do_git_commit(message):
     with cd('/'):
         sudo('git add .')